@@ -1,13 +1,21 @@
 from flask import Flask, render_template, request, jsonify, send_from_directory
+import io
 import os
+import dlib
 from werkzeug.utils import secure_filename
-from database import init_db, add_missing_person, get_all_missing_persons, get_missing_person_by_id
+from werkzeug.exceptions import RequestEntityTooLarge
+from database import init_db, add_missing_person, get_all_missing_persons, count_missing_persons, get_missing_persons_by_ids, get_missing_person_by_image_hash
 from face_recognition_service import FaceRecognitionService
+from batching_encoder import BatchingEncoder
+from encoding_cache import content_hash
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_BULK_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512MB max per bulk upload
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+app.config['DEFAULT_PAGE_SIZE'] = 50
+app.config['MAX_PAGE_SIZE'] = 200
 
 # Initialize database
 init_db()
@@ -15,18 +23,43 @@ init_db()
 # Initialize face recognition service
 face_service = FaceRecognitionService()
 
+# On the GPU concurrent requests share batched encode calls on the single loaded model.
+# Without CUDA dlib encodes one image at a time anyway, so a shared batching thread
+# would only serialize requests; each request thread encodes its own upload instead.
+# Interactive uploads keep dlib's default upsampling, so small faces are found on both paths.
+encoder = BatchingEncoder(
+    face_service, encode_kwargs={'number_of_times_to_upsample': 1}
+) if dlib.DLIB_USE_CUDA else None
+
+def encode_upload(image_data, image_hash=None):
+    """Encode the contents of an uploaded photo; returns the encoding or None if no face is found"""
+    if encoder is not None:
+        return encoder.submit(image_data, image_hash).result()
+    return face_service.encode_face_bytes(image_data, image_hash)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def upload_path(filename, image_hash):
+    """Where to store an uploaded photo; the content hash prefix keeps photos with the same file name apart"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{image_hash[:16]}_{secure_filename(filename)}")
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/api/missing-persons', methods=['GET'])
 def get_missing_persons():
-    """Get all missing persons from database"""
-    persons = get_all_missing_persons()
-    return jsonify([{
+    """
+    Get one page of missing persons from database (?page=1&size=50).
+    The total number of persons is sent in the X-Total-Count header.
+    """
+    page = max(request.args.get('page', 1, type=int), 1)
+    size = request.args.get('size', app.config['DEFAULT_PAGE_SIZE'], type=int)
+    size = min(max(size, 1), app.config['MAX_PAGE_SIZE'])
+    
+    persons = get_all_missing_persons(limit=size, offset=(page - 1) * size)
+    response = jsonify([{
         'id': p['id'],
         'name': p['name'],
         'age': p['age'],
@@ -34,6 +67,8 @@ def get_missing_persons():
         'date_missing': p['date_missing'],
         'contact': p['contact']
     } for p in persons])
+    response.headers['X-Total-Count'] = str(count_missing_persons())
+    return response
 
 @app.route('/api/missing-persons', methods=['POST'])
 def add_person():
@@ -59,14 +94,25 @@ def add_person():
         if not name:
             return jsonify({'error': 'Name is required'}), 400
         
+        image_data = file.read()
+        image_hash = content_hash(image_data)
+        
+        # The same photo is only registered once
+        existing = get_missing_person_by_image_hash(image_hash)
+        if existing:
+            return jsonify({
+                'error': 'This photo has already been added',
+                'id': existing['id']
+            }), 409
+        
         # Save uploaded file
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        filepath = upload_path(file.filename, image_hash)
+        with open(filepath, 'wb') as f:
+            f.write(image_data)
         
         # Process face encoding
-        encoding = face_service.encode_face(filepath)
+        encoding = encode_upload(image_data, image_hash)
         if encoding is None:
             os.remove(filepath)
             return jsonify({'error': 'No face detected in image. Please upload a clear photo with a visible face.'}), 400
@@ -79,7 +125,8 @@ def add_person():
             date_missing=date_missing,
             contact=contact,
             photo_path=filepath,
-            face_encoding=encoding
+            face_encoding=encoding,
+            image_hash=image_hash
         )
         
         return jsonify({
@@ -91,6 +138,85 @@ def add_person():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/missing-persons/bulk', methods=['POST'])
+def add_persons_bulk():
+    """Add several missing persons at once, one per uploaded photo"""
+    # A directory of phone photos is far larger than the single-photo limit
+    request.max_content_length = app.config['MAX_BULK_CONTENT_LENGTH']
+    try:
+        files = request.files.getlist('photos')
+        if all(f.filename == '' for f in files):
+            return jsonify({'error': 'No photos provided'}), 400
+        
+        # Optional names in the same order as the photo inputs; defaults to the file name
+        names = request.form.getlist('names')
+        description = request.form.get('description', '').strip()
+        date_missing = request.form.get('date_missing', '').strip()
+        contact = request.form.get('contact', '').strip()
+        
+        uploads = []
+        skipped = []
+        seen_hashes = set()
+        for i, file in enumerate(files):
+            if file.filename == '':
+                continue
+            if not allowed_file(file.filename):
+                skipped.append({'filename': file.filename, 'error': 'Invalid file type'})
+                continue
+            
+            image_data = file.read()
+            image_hash = content_hash(image_data)
+            if image_hash in seen_hashes or get_missing_person_by_image_hash(image_hash):
+                skipped.append({'filename': file.filename, 'error': 'Photo has already been added'})
+                continue
+            seen_hashes.add(image_hash)
+            
+            name = names[i].strip() if i < len(names) and names[i].strip() else os.path.splitext(secure_filename(file.filename))[0]
+            uploads.append((file.filename, name, image_data, image_hash))
+        
+        # Detect and encode all faces in one batched pass, straight from the uploaded bytes
+        # Bulk imports skip upsampling for speed; small faces may be missed
+        encodings = face_service.encode_faces_batch(
+            [io.BytesIO(image_data) for _, _, image_data, _ in uploads], number_of_times_to_upsample=0
+        )
+        
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        added = []
+        for (original_name, name, image_data, image_hash), encoding in zip(uploads, encodings):
+            if encoding is None:
+                skipped.append({'filename': original_name, 'error': 'No face detected in image'})
+                continue
+            
+            # Only photos with a face are kept
+            filepath = upload_path(original_name, image_hash)
+            with open(filepath, 'wb') as f:
+                f.write(image_data)
+            
+            person_id = add_missing_person(
+                name=name,
+                age='',
+                description=description,
+                date_missing=date_missing,
+                contact=contact,
+                photo_path=filepath,
+                face_encoding=encoding,
+                image_hash=image_hash
+            )
+            added.append({'id': person_id, 'name': name, 'filename': original_name})
+        
+        return jsonify({
+            'success': True,
+            'added': added,
+            'skipped': skipped,
+            'message': f'{len(added)} missing person(s) added'
+        }), 201
+        
+    except RequestEntityTooLarge:
+        limit_mb = app.config['MAX_BULK_CONTENT_LENGTH'] // (1024 * 1024)
+        return jsonify({'error': f'Upload too large; a bulk upload may be at most {limit_mb} MB'}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/search', methods=['POST'])
 def search_face():
     """Search for a face in the missing persons database"""
@@ -105,28 +231,21 @@ def search_face():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Invalid file type'}), 400
         
-        # Save uploaded file temporarily
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'temp_{filename}')
-        file.save(filepath)
-        
-        # Encode the face
-        encoding = face_service.encode_face(filepath)
+        # Encode the face straight from the upload; search photos are not kept
+        encoding = encode_upload(file.read())
         if encoding is None:
-            os.remove(filepath)
             return jsonify({'error': 'No face detected in image. Please upload a clear photo with a visible face.'}), 400
         
         # Search for matches
         matches = face_service.find_matches(encoding, threshold=0.6)
         
-        # Clean up temp file
-        os.remove(filepath)
+        # Fetch all matched persons in a single query
+        persons = get_missing_persons_by_ids([match['person_id'] for match in matches])
         
         # Format results
         results = []
         for match in matches:
-            person = get_missing_person_by_id(match['person_id'])
+            person = persons.get(match['person_id'])
             if person:
                 results.append({
                     'person_id': match['person_id'],
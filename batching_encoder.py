@@ -0,0 +1,84 @@
+"""
+Groups concurrent face encoding requests into batches.
+Requests arriving within a short window share one encode_faces_batch call,
+so a single loaded model serves many request threads. Photos already in the
+service's encoding cache are answered without queueing.
+"""
+import io
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from encoding_cache import content_hash
+
+class BatchingEncoder:
+    """Encode uploaded images in batches on a background thread"""
+
+    def __init__(self, face_service, max_batch=8, max_wait_ms=20, encode_kwargs=None):
+        """encode_kwargs are extra keyword arguments for the service's encode_faces_batch"""
+        self.face_service = face_service
+        self.encode_kwargs = encode_kwargs or {}
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='batching-encoder', daemon=True)
+        self._worker.start()
+
+    def submit(self, image_data, image_hash=None):
+        """
+        Queue the contents of an image file for encoding.
+        image_hash is the content_hash of image_data, if the caller already computed it.
+        Returns a Future whose result is the face encoding, or None if no face is found.
+        """
+        if image_hash is None:
+            image_hash = content_hash(image_data)
+
+        future = Future()
+        found, encoding = self.face_service.encoding_cache.lookup(image_hash)
+        if found:
+            future.set_result(encoding)
+        else:
+            self._queue.put((image_data, image_hash, future))
+        return future
+
+    def _next_batch(self):
+        """Block for the first request, then collect more until the batch is full or the window closes"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            futures = [future for _, _, future in batch]
+
+            try:
+                try:
+                    # The service caches the results it got from the model, never its failures
+                    encodings = self.face_service.encode_faces_batch(
+                        [io.BytesIO(image_data) for image_data, _, _ in batch],
+                        cache_keys=[image_hash for _, image_hash, _ in batch],
+                        **self.encode_kwargs
+                    )
+                except Exception as e:
+                    # Retry one by one so a single bad upload does not fail the whole batch
+                    print(f"Batch encoding failed, encoding one by one: {e}")
+                    encodings = [self.face_service.encode_face_bytes(image_data, image_hash)
+                                 for image_data, image_hash, _ in batch]
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for (_, _, future), encoding in zip(batch, encodings):
+                future.set_result(encoding)
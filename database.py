@@ -1,14 +1,81 @@
 import sqlite3
 import json
 import os
+import threading
 from datetime import datetime
+import numpy as np
+from faiss_index import sync_index
+from distance_kernels import quantize_rows
 
 DB_NAME = 'missing_persons.db'
 
+class _GrowableRows:
+    """
+    Row-aligned arrays in preallocated buffers that double in capacity when full,
+    so appending rows is amortized O(1) instead of copying everything each time.
+    append returns views of the filled rows. Rows are only ever appended, so a
+    view handed out earlier stays valid: later rows are written past its end,
+    or into a new buffer once the old one is full.
+    """
+
+    def __init__(self):
+        self._buffers = None
+        self.size = 0
+
+    def append(self, *columns):
+        """Append rows (one array per column, equal lengths) and return views of all rows"""
+        count = len(columns[0])
+        if self._buffers is None:
+            if count == 0:
+                # Nothing to size the buffers from yet (e.g. an empty database)
+                return columns
+            self._buffers = [np.empty((max(2 * count, 1024),) + column.shape[1:], dtype=column.dtype)
+                             for column in columns]
+        elif self.size + count > len(self._buffers[0]):
+            capacity = max(2 * len(self._buffers[0]), self.size + count)
+            grown = []
+            for buffer in self._buffers:
+                new_buffer = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+                new_buffer[:self.size] = buffer[:self.size]
+                grown.append(new_buffer)
+            self._buffers = grown
+
+        for buffer, column in zip(self._buffers, columns):
+            buffer[self.size:self.size + count] = column
+        self.size += count
+        return tuple(buffer[:self.size] for buffer in self._buffers)
+
+# In-memory (ids, matrix) copy of all stored face encodings. Loaded once by
+# init_db and appended to by add_missing_person, so searches never re-read the table.
+# Rows added by other processes are picked up by comparing the highest stored id.
+# The tuples below are views into the growable buffers next to them.
+_embedding_cache = None
+_embedding_rows = _GrowableRows()
+# Unit-length copy of the matrix for cosine search, as (ids, matrix); built on first use
+_unit_embedding_cache = None
+_unit_rows = _GrowableRows()
+# int8 codes of the unit-length matrix, as (ids, matrix, codes, scales, l1_norms); built on first use
+_quantized_embedding_cache = None
+_quantized_rows = _GrowableRows()
+# Serializes extending the unit-length and int8 copies
+_derived_lock = threading.Lock()
+
+# One connection per thread, kept open for the life of the process
+_local = threading.local()
+# SQLite allows a single writer, so writes from this process go through one lock
+_write_lock = threading.Lock()
+
 def get_db_connection():
-    """Create and return a database connection"""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    """Return this thread's database connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME)
+        conn.row_factory = sqlite3.Row
+        # Per-connection settings (journal_mode=WAL is persisted by init_db)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        _local.conn = conn
     return conn
 
 def init_db():
@@ -25,45 +92,84 @@ def init_db():
             date_missing TEXT,
             contact TEXT,
             photo_path TEXT NOT NULL,
-            face_encoding TEXT NOT NULL,
+            face_encoding BLOB NOT NULL,
+            image_hash TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
+    # Databases created before image_hash existed get the column added
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(missing_persons)')]
+    if 'image_hash' not in columns:
+        cursor.execute('ALTER TABLE missing_persons ADD COLUMN image_hash TEXT')
+    
+    # Duplicate uploads are found by the hash of the photo
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_missing_persons_image_hash ON missing_persons (image_hash)')
+    
+    # Listing is ordered by creation time
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_missing_persons_created_at ON missing_persons (created_at)')
+    
+    # Write-ahead logging lets searches read while a person is being added
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     conn.commit()
-    conn.close()
+    
+    # Load all stored encodings into memory once, up front (init_db runs on
+    # every Streamlit rerun, which must not reload the table each time)
+    if _embedding_cache is None:
+        _load_embedding_cache()
 
-def add_missing_person(name, age, description, date_missing, contact, photo_path, face_encoding):
+def add_missing_person(name, age, description, date_missing, contact, photo_path, face_encoding, image_hash=None):
     """Add a new missing person to the database"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Convert face encoding (numpy array) to JSON string
-    encoding_json = json.dumps(face_encoding.tolist())
+    # Store the face encoding as raw float32 bytes
+    encoding = np.asarray(face_encoding, dtype=np.float32).ravel()
+    encoding_blob = sqlite3.Binary(encoding.tobytes())
     
-    cursor.execute('''
-        INSERT INTO missing_persons (name, age, description, date_missing, contact, photo_path, face_encoding)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (name, age, description, date_missing, contact, photo_path, encoding_json))
+    with _write_lock:
+        cursor.execute('''
+            INSERT INTO missing_persons (name, age, description, date_missing, contact, photo_path, face_encoding, image_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, age, description, date_missing, contact, photo_path, encoding_blob, image_hash))
+        
+        person_id = cursor.lastrowid
+        conn.commit()
+        
+        # Fetch the new row together with any rows other processes stored since
+        # the last refresh, so the in-memory copy never skips an id
+        snapshot = _fetch_new_rows() if _embedding_cache is not None else None
     
-    person_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    # Outside _write_lock: the index takes its own lock, and building it takes _write_lock
+    if snapshot is not None:
+        sync_index(*snapshot)
     
     return person_id
 
-def get_all_missing_persons():
-    """Get all missing persons from the database"""
+def get_all_missing_persons(limit=50, offset=0):
+    """Get one page of missing persons, newest first, without their face encodings"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM missing_persons ORDER BY created_at DESC')
+    cursor.execute('''
+        SELECT id, name, age, description, date_missing, contact, photo_path, created_at
+        FROM missing_persons
+        ORDER BY created_at DESC, id DESC
+        LIMIT ? OFFSET ?
+    ''', (limit, offset))
     persons = cursor.fetchall()
     
-    conn.close()
-    
     return [dict(person) for person in persons]
 
+def count_missing_persons():
+    """Get the total number of missing persons in the database"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT COUNT(*) FROM missing_persons')
+    return cursor.fetchone()[0]
+
 def get_missing_person_by_id(person_id):
     """Get a missing person by ID"""
     conn = get_db_connection()
@@ -72,27 +178,166 @@ def get_missing_person_by_id(person_id):
     cursor.execute('SELECT * FROM missing_persons WHERE id = ?', (person_id,))
     person = cursor.fetchone()
     
-    conn.close()
+    return dict(person) if person else None
+
+def get_missing_person_by_image_hash(image_hash):
+    """Get the missing person whose photo has the given content hash, if any"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM missing_persons WHERE image_hash = ? LIMIT 1', (image_hash,))
+    person = cursor.fetchone()
     
     return dict(person) if person else None
 
+def get_missing_persons_by_ids(person_ids):
+    """Get several missing persons in one query, returned as a dict keyed by ID"""
+    person_ids = [int(person_id) for person_id in person_ids]
+    if not person_ids:
+        return {}
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    placeholders = ','.join('?' * len(person_ids))
+    cursor.execute(f'SELECT * FROM missing_persons WHERE id IN ({placeholders})', person_ids)
+    persons = cursor.fetchall()
+    
+    return {person['id']: dict(person) for person in persons}
+
+def decode_face_encoding(value):
+    """Decode a stored face encoding into a float32 numpy array"""
+    # Rows written before the BLOB column hold the encoding as JSON text
+    if isinstance(value, str):
+        return np.asarray(json.loads(value), dtype=np.float32)
+    return np.frombuffer(value, dtype=np.float32)
+
 def get_all_face_encodings():
-    """Get all face encodings for matching"""
+    """
+    Get all face encodings for matching, read straight from the database.
+    Returns (ids, matrix) where row i of the float32 matrix is the encoding of person ids[i]
+    and ids are in ascending order.
+    Deprecated for searching: use get_embedding_matrix, which serves the in-memory copy.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT id, face_encoding FROM missing_persons')
+    cursor.execute('SELECT id, face_encoding FROM missing_persons ORDER BY id')
+    results = cursor.fetchall()
+    
+    ids = np.array([row['id'] for row in results], dtype=np.int64)
+    if not results:
+        return ids, np.empty((0, 0), dtype=np.float32)
+    
+    values = [row['face_encoding'] for row in results]
+    if all(isinstance(value, bytes) for value in values):
+        # Decode every row with a single frombuffer over the concatenated blobs
+        matrix = np.frombuffer(b''.join(values), dtype=np.float32).reshape(len(values), -1)
+    else:
+        matrix = np.vstack([decode_face_encoding(value) for value in values])
+    
+    return ids, matrix
+
+def _load_embedding_cache():
+    """Read every stored encoding into the in-memory copy, unless another thread already did"""
+    global _embedding_cache
+    with _write_lock:
+        if _embedding_cache is None:
+            _embedding_cache = _embedding_rows.append(*get_all_face_encodings())
+    return _embedding_cache
+
+def _fetch_new_rows():
+    """
+    Append every stored row with an id above the last cached one to the in-memory copy.
+    Must be called with _write_lock held. Returns the updated (ids, matrix).
+    """
+    global _embedding_cache
+    ids, _ = _embedding_cache
+    last_id = int(ids[-1]) if len(ids) > 0 else 0
+    
+    cursor = get_db_connection().cursor()
+    cursor.execute('SELECT id, face_encoding FROM missing_persons WHERE id > ? ORDER BY id', (last_id,))
     results = cursor.fetchall()
+    if results:
+        new_ids = np.array([row['id'] for row in results], dtype=np.int64)
+        new_matrix = np.vstack([decode_face_encoding(row['face_encoding']) for row in results])
+        _embedding_cache = _embedding_rows.append(new_ids, new_matrix)
+    
+    return _embedding_cache
+
+def _append_new_encodings():
+    """Append rows written by other processes (e.g. another app instance) to the in-memory copy"""
+    cursor = get_db_connection().cursor()
     
-    conn.close()
+    # Every insert in this process also fetches the rows before it, so the
+    # copy holds all ids up to its last one and MAX(id) tells whether it is current
+    cursor.execute('SELECT MAX(id) FROM missing_persons')
+    max_id = cursor.fetchone()[0]
+    ids, _ = _embedding_cache
+    if max_id is None or (len(ids) > 0 and max_id <= ids[-1]):
+        return
     
-    encodings = []
-    for row in results:
-        encoding = json.loads(row['face_encoding'])
-        encodings.append({
-            'person_id': row['id'],
-            'encoding': encoding
-        })
+    with _write_lock:
+        snapshot = _fetch_new_rows()
+    sync_index(*snapshot)
+
+def get_embedding_matrix():
+    """
+    Get all face encodings stacked into a single matrix for vectorized matching.
+    Returns (ids, matrix) like get_all_face_encodings, from the in-memory copy
+    kept up to date by add_missing_person.
+    """
+    if _embedding_cache is None:
+        _load_embedding_cache()
+    else:
+        _append_new_encodings()
+    
+    return _embedding_cache
+
+def get_unit_embedding_matrix():
+    """
+    Like get_embedding_matrix, with every row scaled to unit length for cosine search.
+    Rows stored by older versions (e.g. raw DeepFace embeddings) may not be normalized.
+    Only rows added since the last call are normalized.
+    """
+    global _unit_embedding_cache
+    ids, matrix = get_embedding_matrix()
     
-    return encodings
+    cached = _unit_embedding_cache
+    if cached is not None and len(cached[0]) >= len(ids):
+        return cached
+    
+    with _derived_lock:
+        cached = _unit_embedding_cache
+        if cached is not None and len(cached[0]) >= len(ids):
+            return cached
+        
+        new_rows = matrix[_unit_rows.size:len(ids)]
+        new_rows = new_rows / (np.linalg.norm(new_rows, axis=1, keepdims=True) + 1e-12)
+        unit_matrix, = _unit_rows.append(new_rows.astype(np.float32, copy=False))
+        
+        _unit_embedding_cache = (ids, unit_matrix)
+    return _unit_embedding_cache
 
+def get_quantized_embedding_matrix():
+    """
+    Like get_unit_embedding_matrix, together with int8 codes of every row for fast scans.
+    Returns (ids, matrix, codes, scales, l1_norms) as one consistent snapshot;
+    see distance_kernels.quantize_rows. Only rows added since the last call are quantized.
+    """
+    global _quantized_embedding_cache
+    ids, matrix = get_unit_embedding_matrix()
+    
+    cached = _quantized_embedding_cache
+    if cached is not None and len(cached[0]) >= len(ids):
+        return cached
+    
+    with _derived_lock:
+        cached = _quantized_embedding_cache
+        if cached is not None and len(cached[0]) >= len(ids):
+            return cached
+        
+        codes, scales, l1_norms = _quantized_rows.append(*quantize_rows(matrix[_quantized_rows.size:len(ids)]))
+        
+        _quantized_embedding_cache = (ids, matrix, codes, scales, l1_norms)
+    return _quantized_embedding_cache
@@ -0,0 +1,175 @@
+"""
+Distance kernels for scanning all stored face encodings.
+NumPy hands the scan to BLAS, which is the fastest option whenever NumPy is
+linked against an optimized BLAS (OpenBLAS, MKL, Accelerate). On minimal builds
+without one, a Numba kernel computes every distance in one parallel pass instead.
+Large databases can also be scanned on an int8 copy of the encodings (4x less
+memory traffic), with exact float32 distances computed for the rows that may match.
+The encoding helpers and the match search shared by the face recognition
+services live here as well.
+"""
+import numpy as np
+from faiss_index import INDEX_AVAILABLE, SEARCH_K, search_index
+
+def _blas_available():
+    """Check whether NumPy was built against an optimized BLAS library"""
+    try:
+        blas = np.show_config(mode='dicts')['Build Dependencies']['blas']
+        return bool(blas.get('found'))
+    except Exception:
+        # Older NumPy has no machine-readable build config; its wheels bundle OpenBLAS
+        return True
+
+BLAS_AVAILABLE = _blas_available()
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# The float32 Numba kernel only beats NumPy when BLAS is missing
+USE_NUMBA = NUMBA_AVAILABLE and not BLAS_AVAILABLE
+
+# NumPy's int8 matmul is slower than float32 BLAS, so the int8 scan needs Numba
+INT8_SCAN_AVAILABLE = NUMBA_AVAILABLE
+INT8_MIN_ROWS = 20000  # Smaller matrices fit in cache and gain nothing from int8
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _all_cosine_distances(matrix, query):
+        out = np.empty(matrix.shape[0], dtype=np.float32)
+        for i in prange(matrix.shape[0]):
+            s = np.float32(0.0)
+            for j in range(matrix.shape[1]):
+                s += matrix[i, j] * query[j]
+            out[i] = 1.0 - s
+        return out
+    
+    @njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+    def _all_cosine_distances_512(matrix, query):
+        # Same as _all_cosine_distances with the width of the CLIP and simple encodings
+        # fixed at compile time, so the inner loop is fully unrolled into SIMD FMAs
+        out = np.empty(matrix.shape[0], dtype=np.float32)
+        for i in prange(matrix.shape[0]):
+            s = np.float32(0.0)
+            for j in range(512):
+                s += matrix[i, j] * query[j]
+            out[i] = 1.0 - s
+        return out
+    
+    @njit(parallel=True, cache=True)
+    def _all_int8_dots(codes, query_codes):
+        out = np.empty(codes.shape[0], dtype=np.int32)
+        for i in prange(codes.shape[0]):
+            s = np.int32(0)
+            for j in range(codes.shape[1]):
+                s += np.int32(codes[i, j]) * np.int32(query_codes[j])
+            out[i] = s
+        return out
+
+def as_vec(encoding):
+    """Convert an encoding to a contiguous 1-D float32 array, without copying if it already is one"""
+    return np.ascontiguousarray(encoding, dtype=np.float32).ravel()
+
+def normalize(encoding):
+    """Scale an encoding to unit length so cosine similarity is a plain dot product"""
+    encoding = as_vec(encoding)
+    return (encoding / (np.linalg.norm(encoding) + 1e-12)).tolist()
+
+def scan_cosine_distances(matrix, query):
+    """
+    Cosine distance from a query to every row of an (N, D) matrix.
+    Both the query and the rows must already be unit length.
+    """
+    if USE_NUMBA:
+        kernel = _all_cosine_distances_512 if matrix.shape[1] == 512 else _all_cosine_distances
+        return kernel(
+            np.ascontiguousarray(matrix, dtype=np.float32),
+            np.ascontiguousarray(query, dtype=np.float32)
+        )
+    return 1 - matrix @ query
+
+def quantize_rows(matrix):
+    """
+    Quantize each row of a float matrix to int8 with its own scale (127 / max |x|).
+    Returns (codes, scales, l1_norms); the L1 norms bound the quantization error.
+    """
+    max_abs = np.abs(matrix).max(axis=1) if matrix.size else np.empty(0, dtype=np.float32)
+    scales = (127 / np.maximum(max_abs, 1e-12)).astype(np.float32)
+    codes = np.clip(np.rint(matrix * scales[:, None]), -127, 127).astype(np.int8)
+    l1_norms = np.abs(matrix).sum(axis=1).astype(np.float32)
+    return codes, scales, l1_norms
+
+def scan_cosine_distances_int8(matrix, codes, scales, l1_norms, query, threshold):
+    """
+    Cosine distance from a query to every row of an (N, D) unit-length matrix,
+    scanning its int8 codes (from quantize_rows) first.
+    Rows that may be within the threshold get their exact distance from the
+    float32 matrix; every other row gets infinity.
+    """
+    query_codes, query_scales, query_l1 = quantize_rows(query.reshape(1, -1))
+    approx = _all_int8_dots(codes, query_codes[0]) / (scales * query_scales[0])
+    
+    # Rounding moves every element by at most half a quantization step, which
+    # bounds how far the int8 dot product can be from the exact one
+    error = 0.5 * query_l1[0] / scales + 0.5 * l1_norms / query_scales[0] + 0.25 * codes.shape[1] / (scales * query_scales[0])
+    
+    distances = np.full(len(codes), np.inf, dtype=np.float32)
+    rows = np.where(1 - approx - error <= threshold)[0]
+    distances[rows] = 1 - matrix[rows] @ query
+    return distances
+
+def cosine_search(query_encoding, threshold, top_k=None):
+    """
+    Cosine distances from a query encoding to the stored encodings that may match.
+    With an index (FAISS or hnswlib) installed these are the top_k (or SEARCH_K)
+    nearest faces; otherwise every stored row is scanned, through the int8 copy
+    on large databases. Returns (ids, distances) numpy arrays.
+    """
+    # database imports this module, so it is imported on first use
+    from database import get_unit_embedding_matrix, get_quantized_embedding_matrix
+    
+    # Normalize the query once; stored encodings are normalized once when cached
+    query_encoding = as_vec(query_encoding)
+    query_encoding = query_encoding / (np.linalg.norm(query_encoding) + 1e-12)
+    
+    if INDEX_AVAILABLE:
+        # Nearest stored encodings from the ANN index
+        return search_index(query_encoding, metric='cosine', k=top_k or SEARCH_K)
+    
+    # Get all encodings from database as one (N, D) matrix of unit rows
+    person_ids, stored_matrix = get_unit_embedding_matrix()
+    if len(person_ids) == 0:
+        return person_ids, np.empty(0, dtype=np.float32)
+    
+    if INT8_SCAN_AVAILABLE and len(person_ids) >= INT8_MIN_ROWS:
+        # Scan the int8 copy; only rows that may match get exact distances
+        person_ids, stored_matrix, codes, scales, l1_norms = get_quantized_embedding_matrix()
+        return person_ids, scan_cosine_distances_int8(stored_matrix, codes, scales, l1_norms, query_encoding, threshold)
+    
+    # On unit vectors cosine similarity is a plain dot product,
+    # computed for every stored encoding in a single pass
+    return person_ids, scan_cosine_distances(stored_matrix, query_encoding)
+
+def select_matches(person_ids, distances, threshold, top_k=None):
+    """
+    Turn search distances into the match list returned by find_matches: the rows
+    within the threshold, closest first, at most top_k of them, each as a dict
+    with person_id, distance and confidence.
+    """
+    # Keep rows below the threshold, closest first
+    candidates = np.where(distances <= threshold)[0]
+    if top_k is not None and len(candidates) > top_k:
+        # Select the top_k closest in linear time, so only those get sorted
+        candidates = candidates[np.argpartition(distances[candidates], top_k - 1)[:top_k]]
+    candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+    
+    # Convert distance to confidence (0-1 scale, inverted), for all candidates at once
+    confidences = np.clip(1 - distances[candidates] / threshold, 0, 1)
+    
+    return [{
+        'person_id': int(person_ids[idx]),
+        'distance': float(distances[idx]),
+        'confidence': float(confidence)
+    } for idx, confidence in zip(candidates, confidences)]
@@ -0,0 +1,47 @@
+"""
+Content-addressed cache of face encodings.
+Photos that are uploaded again (retries, repeated searches) are recognised by a
+hash of their bytes and answered from memory instead of running the encoder.
+Only real encoder results are cached: an encoding, or None when the encoder
+found no face. Encoders signal failures by raising, which stores nothing, so
+a transient error is retried on the next upload of the same photo.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+def content_hash(image_data):
+    """Hex digest identifying an image file by its contents"""
+    # BLAKE2b is in the standard library and hashes at several GB/s
+    return hashlib.blake2b(image_data, digest_size=32).hexdigest()
+
+class EncodingCache:
+    """Thread-safe LRU cache from content hash to face encoding (None when no face was found)"""
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Return (True, encoding) on a hit, (False, None) on a miss"""
+        with self._lock:
+            if key not in self._items:
+                return False, None
+            self._items.move_to_end(key)
+            return True, self._items[key]
+
+    def store(self, key, encoding):
+        with self._lock:
+            self._items[key] = encoding
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Return the cached encoding for key, computing and storing it on a miss (nothing is stored if compute raises)"""
+        found, encoding = self.lookup(key)
+        if not found:
+            encoding = compute()
+            self.store(key, encoding)
+        return encoding
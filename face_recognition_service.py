@@ -1,12 +1,19 @@
+import dlib
 import face_recognition
 import numpy as np
-from database import get_all_face_encodings
+from database import get_embedding_matrix
+from image_io import decode_image
+from encoding_cache import EncodingCache, content_hash
+from faiss_index import INDEX_AVAILABLE, SEARCH_K, search_index
+from distance_kernels import as_vec, select_matches
 
 class FaceRecognitionService:
     """Service for face recognition operations"""
     
     def __init__(self):
         self.tolerance = 0.6  # Lower = more strict matching
+        self.encoding_cache = EncodingCache(maxsize=512)
+        self.min_face_area = 20 * 20  # Faces smaller than this (in pixels) are ignored
     
     def encode_face(self, image_path):
         """
@@ -20,86 +27,156 @@ class FaceRecognitionService:
             # Find face locations
             face_locations = face_recognition.face_locations(image)
             
-            if len(face_locations) == 0:
-                return None
-            
-            # If multiple faces, use the largest one
-            if len(face_locations) > 1:
-                # Calculate face sizes and pick the largest
-                face_sizes = [(bottom - top) * (right - left) 
-                             for (top, right, bottom, left) in face_locations]
-                largest_face_idx = face_sizes.index(max(face_sizes))
-                face_locations = [face_locations[largest_face_idx]]
-            
-            # Get face encodings
-            face_encodings = face_recognition.face_encodings(image, face_locations)
-            
-            if len(face_encodings) == 0:
-                return None
-            
-            return face_encodings[0]
+            return self._encode_largest_face(image, face_locations)
             
         except Exception as e:
             print(f"Error encoding face: {e}")
             return None
     
-    def find_matches(self, query_encoding, threshold=0.6):
+    def encode_face_bytes(self, image_data, image_hash=None):
+        """
+        Encode a face from the contents of an image file, without writing it to disk.
+        Identical uploads are answered from the encoding cache; image_hash is the
+        content_hash of image_data, if the caller already computed it.
+        Returns the face encoding as a numpy array, or None if no face is found.
+        """
+        try:
+            return self.encoding_cache.get_or_compute(
+                image_hash or content_hash(image_data), lambda: self._encode_face_bytes(image_data)
+            )
+        except Exception as e:
+            # Failures are not cached, so the same photo is encoded again next time
+            print(f"Error encoding face: {e}")
+            return None
+    
+    def _encode_face_bytes(self, image_data):
+        """Run the encoder on the contents of an image file; raises on errors"""
+        image = decode_image(image_data)
+        face_locations = face_recognition.face_locations(image)
+        
+        return self._encode_largest_face(image, face_locations)
+    
+    def encode_faces_batch(self, image_paths, batch_size=128, number_of_times_to_upsample=1, cache_keys=None):
+        """
+        Encode faces from several image files (paths or file-like objects) at once.
+        Returns a list with one face encoding (or None if no face is found) per image.
+        number_of_times_to_upsample is passed to the face detector; the default of 1
+        matches encode_face, 0 is faster but misses small faces.
+        cache_keys, one content hash per image, stores the results in the encoding
+        cache, except for images that failed to load or encode.
+        """
+        failed = set()
+        images = []
+        for i, image_path in enumerate(image_paths):
+            try:
+                if isinstance(image_path, str):
+                    images.append(face_recognition.load_image_file(image_path))
+                else:
+                    # Uploads arrive as file-like objects; decode them with libjpeg-turbo when installed
+                    images.append(decode_image(image_path.read()))
+            except Exception as e:
+                print(f"Error loading image {image_path}: {e}")
+                images.append(None)
+                failed.add(i)
+        
+        loaded = [i for i, image in enumerate(images) if image is not None]
+        face_locations = [[] for _ in images]
+        
+        if dlib.DLIB_USE_CUDA:
+            # Run the CNN detector on the GPU in batches; a batch must share one image size
+            by_shape = {}
+            for i in loaded:
+                by_shape.setdefault(images[i].shape, []).append(i)
+            
+            for indices in by_shape.values():
+                batch_locations = face_recognition.batch_face_locations(
+                    [images[i] for i in indices], number_of_times_to_upsample=number_of_times_to_upsample, batch_size=batch_size
+                )
+                for i, locations in zip(indices, batch_locations):
+                    face_locations[i] = locations
+        else:
+            # Without CUDA the CNN detector is far slower than HOG, so detect per image
+            for i in loaded:
+                face_locations[i] = face_recognition.face_locations(images[i], number_of_times_to_upsample)
+        
+        encodings = []
+        for i, (image, locations) in enumerate(zip(images, face_locations)):
+            try:
+                encodings.append(self._encode_largest_face(image, locations) if image is not None else None)
+            except Exception as e:
+                print(f"Error encoding face: {e}")
+                encodings.append(None)
+                failed.add(i)
+        
+        if cache_keys is not None:
+            for i, (key, encoding) in enumerate(zip(cache_keys, encodings)):
+                if i not in failed:
+                    self.encoding_cache.store(key, encoding)
+        
+        return encodings
+    
+    def _encode_largest_face(self, image, face_locations):
+        """Encode the largest of the detected faces, or return None if there are none"""
+        if len(face_locations) == 0:
+            return None
+        
+        # Face sizes from the (top, right, bottom, left) boxes
+        locations = np.asarray(face_locations)
+        areas = (locations[:, 2] - locations[:, 0]) * (locations[:, 1] - locations[:, 3])
+        
+        # Tiny detections are usually false positives; skip them before the encoder runs
+        if areas.max() < self.min_face_area:
+            return None
+        
+        # If multiple faces, use the largest one
+        top, right, bottom, left = (int(v) for v in locations[areas.argmax()])
+        
+        # Get face encodings
+        face_encodings = face_recognition.face_encodings(image, [(top, right, bottom, left)])
+        
+        if len(face_encodings) == 0:
+            return None
+        
+        return face_encodings[0]
+    
+    def find_matches(self, query_encoding, threshold=0.6, top_k=None):
         """
         Find matches for a query face encoding in the database.
         
         Args:
             query_encoding: numpy array of the face encoding to search for
             threshold: distance threshold for matching (lower = more strict)
+            top_k: return at most this many matches. None returns every match when
+                the whole matrix is scanned, but with an index (FAISS or hnswlib)
+                installed only the SEARCH_K (10) nearest faces are considered
         
         Returns:
-            List of matches with person_id, distance, and confidence
+            List of matches with person_id, distance, and confidence, closest first
         """
-        matches = []
+        query_encoding = as_vec(query_encoding)
         
-        # Get all encodings from database
-        stored_encodings = get_all_face_encodings()
-        
-        if not stored_encodings:
-            return matches
-        
-        # Convert query encoding to numpy array if needed
-        if isinstance(query_encoding, list):
-            query_encoding = np.array(query_encoding)
-        
-        for stored in stored_encodings:
-            # Convert stored encoding to numpy array
-            stored_encoding = np.array(stored['encoding'])
+        if INDEX_AVAILABLE:
+            # Nearest stored encodings from the ANN index
+            person_ids, distances = search_index(query_encoding, metric='euclidean', k=top_k or SEARCH_K)
+        else:
+            # Get all encodings from database as one (N, D) matrix
+            person_ids, stored_matrix = get_embedding_matrix()
             
-            # Calculate face distance
-            distance = face_recognition.face_distance([stored_encoding], query_encoding)[0]
+            if len(person_ids) == 0:
+                return []
             
-            # Check if distance is below threshold
-            if distance <= threshold:
-                # Convert distance to confidence (0-1 scale, inverted)
-                # Lower distance = higher confidence
-                confidence = 1 - (distance / threshold)
-                confidence = max(0, min(1, confidence))  # Clamp between 0 and 1
-                
-                matches.append({
-                    'person_id': stored['person_id'],
-                    'distance': float(distance),
-                    'confidence': float(confidence)
-                })
-        
-        # Sort by distance (closest first)
-        matches.sort(key=lambda x: x['distance'])
-        
-        return matches
+            # Euclidean distance to every stored encoding in a single vectorized pass
+            distances = face_recognition.face_distance(stored_matrix, query_encoding)
+        
+        return select_matches(person_ids, distances, threshold, top_k)
     
     def compare_faces(self, encoding1, encoding2, threshold=0.6):
         """
         Compare two face encodings.
         Returns True if faces match, False otherwise.
         """
-        if isinstance(encoding1, list):
-            encoding1 = np.array(encoding1)
-        if isinstance(encoding2, list):
-            encoding2 = np.array(encoding2)
+        encoding1 = as_vec(encoding1)
+        encoding2 = as_vec(encoding2)
         
         distance = face_recognition.face_distance([encoding1], encoding2)[0]
         return distance <= threshold, float(distance)
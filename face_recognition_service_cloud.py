@@ -3,7 +3,9 @@ Cloud-compatible face recognition service using deepface.
 This version works on Streamlit Cloud without requiring dlib/cmake.
 """
 import numpy as np
-from database import get_all_face_encodings
+from image_io import decode_image
+from encoding_cache import EncodingCache, content_hash
+from distance_kernels import as_vec, normalize, cosine_search, select_matches
 
 try:
     from deepface import DeepFace
@@ -17,14 +19,23 @@ class FaceRecognitionService:
     
     def __init__(self):
         self.tolerance = 0.6  # Lower = more strict matching
+        self.encoding_cache = EncodingCache(maxsize=512)
         if not DEEPFACE_AVAILABLE:
             raise ImportError("deepface is required. Install with: pip install deepface")
     
     def encode_face(self, image_path):
         """
-        Encode a face from an image file using DeepFace.
+        Encode a face from an image file (or a BGR numpy image) using DeepFace.
         Returns the face encoding as a list, or None if no face is found.
         """
+        try:
+            return self._encode_face(image_path)
+        except Exception as e:
+            print(f"Error encoding face: {e}")
+            return None
+    
+    def _encode_face(self, image_path):
+        """Like encode_face, but raises on errors other than a missing face"""
         try:
             # Use DeepFace to get face embedding
             # Using VGG-Face model which is good for face recognition
@@ -36,14 +47,6 @@ class FaceRecognitionService:
                 detector_backend='opencv',  # OpenCV doesn't require dlib and avoids Keras issues
                 silent=True  # Suppress warnings
             )
-            
-            if embedding and len(embedding) > 0:
-                # Get the first face's embedding
-                encoding = embedding[0]['embedding']
-                return encoding
-            else:
-                return None
-                
         except Exception as e:
             error_msg = str(e).lower()
             # If face detection fails, return None (don't raise error)
@@ -55,105 +58,115 @@ class FaceRecognitionService:
                 "valid_for_keras3",
                 "keras"
             ]):
-                # Try with a simpler approach if Keras issues occur
-                try:
-                    return self._encode_with_simple_backend(image_path)
-                except:
-                    return None
-            # For other errors, log and return None
+                # Try with a simpler approach if Keras issues occur; its errors propagate too
+                return self._encode_with_simple_backend(image_path)
+            # Other errors (e.g. a failing model) propagate so they are never cached
+            raise
+        
+        if embedding and len(embedding) > 0:
+            # Get the first face's embedding
+            encoding = embedding[0]['embedding']
+            return normalize(encoding)
+        return None
+    
+    def encode_face_bytes(self, image_data, image_hash=None):
+        """
+        Encode a face from the contents of an image file, without writing it to disk.
+        Identical uploads are answered from the encoding cache; image_hash is the
+        content_hash of image_data, if the caller already computed it.
+        Returns the face encoding as a list, or None if no face is found.
+        """
+        try:
+            return self.encoding_cache.get_or_compute(
+                image_hash or content_hash(image_data), lambda: self._encode_face_bytes(image_data)
+            )
+        except Exception as e:
+            # Failures are not cached, so the same photo is encoded again next time
             print(f"Error encoding face: {e}")
             return None
     
-    def _encode_with_simple_backend(self, image_path):
-        """Fallback encoding method using simpler backend"""
+    def _encode_face_bytes(self, image_data):
+        """Run the encoder on the contents of an image file; raises on errors"""
+        # DeepFace takes numpy images in OpenCV's BGR channel order
+        return self._encode_face(decode_image(image_data, channel_order='BGR'))
+    
+    def encode_faces_batch(self, image_paths, cache_keys=None):
+        """
+        Encode faces from several image files (paths or file-like objects) in a single DeepFace call.
+        Returns a list with one face encoding (or None if no face is found) per image.
+        cache_keys, one content hash per image, stores the results in the encoding cache.
+        """
+        # Read file-like objects once, so the per-image fallback can decode them again
+        sources = [source if isinstance(source, str) else source.read() for source in image_paths]
         try:
-            # Try with mtcnn backend which is more compatible
-            embedding = DeepFace.represent(
-                img_path=image_path,
+            # File contents are decoded here; DeepFace opens paths itself
+            images = [source if isinstance(source, str) else decode_image(source, channel_order='BGR')
+                      for source in sources]
+            embeddings = DeepFace.represent(
+                img_path=images,
                 model_name='VGG-Face',
                 enforce_detection=False,
-                detector_backend='mtcnn',
+                detector_backend='opencv',
                 silent=True
             )
-            if embedding and len(embedding) > 0:
-                return embedding[0]['embedding']
-        except:
-            pass
+        except Exception as e:
+            # Older deepface releases only accept a single image
+            print(f"Batch encoding unavailable, encoding one by one: {e}")
+            keys = cache_keys if cache_keys is not None else [None] * len(sources)
+            return [self.encode_face(source) if isinstance(source, str) or key is None else self.encode_face_bytes(source, key)
+                    for source, key in zip(sources, keys)]
+        
+        # A single-image batch may come back unwrapped
+        if embeddings and isinstance(embeddings[0], dict):
+            embeddings = [embeddings]
+        
+        encodings = [normalize(faces[0]['embedding']) if faces else None for faces in embeddings]
+        if cache_keys is not None:
+            for key, encoding in zip(cache_keys, encodings):
+                self.encoding_cache.store(key, encoding)
+        return encodings
+    
+    def _encode_with_simple_backend(self, image_path):
+        """Fallback encoding method using simpler backend; raises on errors"""
+        # Try with mtcnn backend which is more compatible
+        embedding = DeepFace.represent(
+            img_path=image_path,
+            model_name='VGG-Face',
+            enforce_detection=False,
+            detector_backend='mtcnn',
+            silent=True
+        )
+        if embedding and len(embedding) > 0:
+            return normalize(embedding[0]['embedding'])
         return None
     
-    def find_matches(self, query_encoding, threshold=0.6):
+    def find_matches(self, query_encoding, threshold=0.6, top_k=None):
         """
         Find matches for a query face encoding in the database.
         
         Args:
             query_encoding: list or numpy array of the face encoding to search for
             threshold: distance threshold for matching (lower = more strict)
+            top_k: return at most this many matches. None returns every match when
+                the whole matrix is scanned, but with an index (FAISS or hnswlib)
+                installed only the SEARCH_K (10) nearest faces are considered
         
         Returns:
-            List of matches with person_id, distance, and confidence
+            List of matches with person_id, distance, and confidence, closest first
         """
-        matches = []
-        
-        # Get all encodings from database
-        stored_encodings = get_all_face_encodings()
-        
-        if not stored_encodings:
-            return matches
-        
-        # Convert query encoding to numpy array if needed
-        if isinstance(query_encoding, list):
-            query_encoding = np.array(query_encoding)
-        
-        for stored in stored_encodings:
-            # Convert stored encoding to numpy array
-            stored_encoding = np.array(stored['encoding'])
-            
-            # Calculate cosine similarity (better for normalized vectors)
-            dot_product = np.dot(query_encoding, stored_encoding)
-            norm_product = np.linalg.norm(query_encoding) * np.linalg.norm(stored_encoding)
-            
-            if norm_product == 0:
-                continue
-                
-            cosine_similarity = dot_product / norm_product
-            cosine_distance = 1 - cosine_similarity
-            
-            # Check if distance is below threshold
-            if cosine_distance <= threshold:
-                # Convert distance to confidence (0-1 scale, inverted)
-                confidence = 1 - (cosine_distance / threshold)
-                confidence = max(0, min(1, confidence))  # Clamp between 0 and 1
-                
-                matches.append({
-                    'person_id': stored['person_id'],
-                    'distance': float(cosine_distance),
-                    'confidence': float(confidence)
-                })
-        
-        # Sort by distance (closest first)
-        matches.sort(key=lambda x: x['distance'])
-        
-        return matches
+        person_ids, cosine_distances = cosine_search(query_encoding, threshold, top_k)
+        return select_matches(person_ids, cosine_distances, threshold, top_k)
     
     def compare_faces(self, encoding1, encoding2, threshold=0.6):
         """
-        Compare two face encodings.
+        Compare two face encodings, as returned by encode_face (unit length).
         Returns True if faces match, False otherwise.
         """
-        if isinstance(encoding1, list):
-            encoding1 = np.array(encoding1)
-        if isinstance(encoding2, list):
-            encoding2 = np.array(encoding2)
-        
-        # Calculate cosine distance
-        dot_product = np.dot(encoding1, encoding2)
-        norm_product = np.linalg.norm(encoding1) * np.linalg.norm(encoding2)
-        
-        if norm_product == 0:
-            return False, 1.0
+        encoding1 = as_vec(encoding1)
+        encoding2 = as_vec(encoding2)
         
-        cosine_similarity = dot_product / norm_product
-        cosine_distance = 1 - cosine_similarity
+        # On unit vectors cosine distance is one minus the dot product
+        cosine_distance = 1 - float(np.dot(encoding1, encoding2))
         
         return cosine_distance <= threshold, float(cosine_distance)
 
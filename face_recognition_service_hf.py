@@ -5,19 +5,105 @@ This version doesn't require dlib and works on Streamlit Cloud.
 import os
 import numpy as np
 from PIL import Image
-import base64
 import io
 from dotenv import load_dotenv
 from huggingface_hub import InferenceClient
-from database import get_all_face_encodings
+from image_io import decode_image
+from encoding_cache import EncodingCache, content_hash
+from distance_kernels import as_vec, normalize, cosine_search, select_matches
 
 load_dotenv()
 
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+CLIP_ONNX_PATH = "clip_vision.onnx"  # CLIP image tower exported for ONNX Runtime
+
+# Load CLIP once per process; encode_face falls back to the simple encoding without it
+try:
+    import torch
+    from transformers import CLIPProcessor, CLIPModel
+    
+    _DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    # Half precision halves activation memory on the GPU; CPUs stay in float32
+    _DTYPE = torch.float16 if _DEVICE == "cuda" else torch.float32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    
+    _MODEL = CLIPModel.from_pretrained(CLIP_MODEL_NAME, torch_dtype=_DTYPE).to(_DEVICE).eval()
+    _PROCESSOR = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+except Exception as e:
+    _MODEL = None
+    _PROCESSOR = None
+    print(f"Warning: CLIP model not available, using simple encoding: {e}")
+
+def _export_clip_onnx(path):
+    """Export CLIP's image tower (vision model and projection) to ONNX, once per deployment"""
+    class ImageFeatures(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+        
+        def forward(self, pixel_values):
+            return self.model.get_image_features(pixel_values=pixel_values)
+    
+    dummy = torch.zeros(1, 3, 224, 224, dtype=_DTYPE, device=_DEVICE)
+    torch.onnx.export(
+        ImageFeatures(_MODEL), (dummy,), path,
+        input_names=["pixel_values"], output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=17
+    )
+
+# Serve the exported graph with ONNX Runtime when it is installed; it fuses
+# the transformer ops and skips PyTorch's per-call overhead
+try:
+    import onnxruntime as ort
+    
+    if _PROCESSOR is None:
+        raise RuntimeError("CLIP processor not available")
+    if not os.path.exists(CLIP_ONNX_PATH):
+        _export_clip_onnx(CLIP_ONNX_PATH)
+    
+    _session_options = ort.SessionOptions()
+    _session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    _ORT_SESSION = ort.InferenceSession(
+        CLIP_ONNX_PATH,
+        _session_options,
+        providers=[p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in ort.get_available_providers()]
+    )
+    # A graph exported on the GPU takes float16 pixels
+    _ORT_INPUT_DTYPE = np.float16 if _ORT_SESSION.get_inputs()[0].type == "tensor(float16)" else np.float32
+except Exception as e:
+    _ORT_SESSION = None
+    if not isinstance(e, ImportError):
+        print(f"Warning: ONNX Runtime not used for CLIP: {e}")
+
+def _clip_image_features(images):
+    """Run CLIP on a list of PIL images and return their L2-normalized features"""
+    if _ORT_SESSION is not None:
+        pixel_values = _PROCESSOR(images=images, return_tensors="np")["pixel_values"]
+        encodings = _ORT_SESSION.run(None, {"pixel_values": pixel_values.astype(_ORT_INPUT_DTYPE)})[0]
+        encodings = encodings.astype(np.float32)
+    else:
+        if _MODEL is None:
+            raise RuntimeError("CLIP model not available")
+        
+        inputs = _PROCESSOR(images=images, return_tensors="pt")
+        inputs = {k: v.to(_DEVICE, dtype=_DTYPE) for k, v in inputs.items()}
+        
+        with torch.inference_mode():
+            image_features = _MODEL.get_image_features(**inputs)
+        
+        # Convert to numpy array
+        encodings = image_features.float().cpu().numpy()
+    
+    # Normalize each row
+    return encodings / np.linalg.norm(encodings, axis=1, keepdims=True)
+
 class FaceRecognitionService:
     """Service for face recognition operations using Hugging Face API"""
     
     def __init__(self):
         self.tolerance = 0.6  # Lower = more strict matching
+        self.encoding_cache = EncodingCache(maxsize=512)
         api_key = os.environ.get("HUGGINGFACE_API_KEY")
         if not api_key:
             raise ValueError("HUGGINGFACE_API_KEY not found in environment variables. Please set it in Streamlit Cloud secrets.")
@@ -31,18 +117,11 @@ class FaceRecognitionService:
         Returns the face encoding as a list, or None if no face is found.
         """
         try:
-            # Read image
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-            
             # Use image-to-text or image feature extraction
             # For face recognition, we'll use a vision model that can extract features
             # Note: This is a simplified approach. For production, consider using
             # a dedicated face recognition model from Hugging Face
             
-            # Convert image to base64 for API
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
-            
             # Use feature extraction - this will give us a vector representation
             # We'll use a vision transformer model
             try:
@@ -52,24 +131,10 @@ class FaceRecognitionService:
                 
                 # Alternative: Use a face detection/recognition model
                 # For now, we'll use a simple approach with image embeddings
-                from transformers import CLIPProcessor, CLIPModel
-                import torch
-                
-                # Load model (this will be cached)
-                if not hasattr(self, '_clip_model'):
-                    self._clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-                    self._clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
                 
                 # Process image
                 image = Image.open(image_path).convert('RGB')
-                inputs = self._clip_processor(images=image, return_tensors="pt")
-                
-                with torch.no_grad():
-                    image_features = self._clip_model.get_image_features(**inputs)
-                
-                # Convert to numpy array and normalize
-                encoding = image_features[0].numpy()
-                encoding = encoding / np.linalg.norm(encoding)  # Normalize
+                encoding = _clip_image_features([image])[0]
                 
                 return encoding.tolist()
                 
@@ -84,6 +149,51 @@ class FaceRecognitionService:
             print(f"Error encoding face: {e}")
             return None
     
+    def encode_face_bytes(self, image_data, image_hash=None):
+        """
+        Encode a face from the contents of an image file, without writing it to disk.
+        Identical uploads are answered from the encoding cache; image_hash is the
+        content_hash of image_data, if the caller already computed it.
+        Returns the face encoding as a list, or None if no face is found.
+        """
+        try:
+            return self.encoding_cache.get_or_compute(
+                image_hash or content_hash(image_data), lambda: self._encode_face_bytes(image_data)
+            )
+        except Exception as e:
+            print(f"Error with CLIP model: {e}")
+            # The pixel-based fallback is not a CLIP embedding, so it is never cached
+            return self._simple_image_encoding(io.BytesIO(image_data))
+    
+    def _encode_face_bytes(self, image_data):
+        """Run CLIP on the contents of an image file; raises on errors"""
+        image = Image.fromarray(decode_image(image_data))
+        return _clip_image_features([image])[0].tolist()
+    
+    def encode_faces_batch(self, image_paths, cache_keys=None):
+        """
+        Encode faces from several image files (paths or file-like objects) with a single CLIP forward pass.
+        Returns a list with one face encoding (or None on failure) per image.
+        cache_keys, one content hash per image, stores the CLIP encodings in the encoding cache.
+        """
+        # Read file-like objects once, so the per-image fallback can decode them again
+        sources = [source if isinstance(source, str) else source.read() for source in image_paths]
+        try:
+            images = [Image.open(source).convert('RGB') if isinstance(source, str) else Image.fromarray(decode_image(source))
+                      for source in sources]
+            encodings = [encoding.tolist() for encoding in _clip_image_features(images)]
+            
+        except Exception as e:
+            print(f"Error with batched CLIP encoding: {e}")
+            keys = cache_keys if cache_keys is not None else [None] * len(sources)
+            return [self.encode_face(source) if isinstance(source, str) else self.encode_face_bytes(source, key)
+                    for source, key in zip(sources, keys)]
+        
+        if cache_keys is not None:
+            for key, encoding in zip(cache_keys, encodings):
+                self.encoding_cache.store(key, encoding)
+        return encodings
+    
     def _simple_image_encoding(self, image_path):
         """
         Simple fallback encoding method.
@@ -94,98 +204,44 @@ class FaceRecognitionService:
             img = Image.open(image_path).convert('RGB')
             img = img.resize((224, 224))
             
-            # Convert to array and flatten
-            img_array = np.array(img).flatten()
-            
-            # Normalize
-            img_array = img_array / 255.0
-            
             # Use PCA-like reduction to get a reasonable encoding size
             # This is a simplified approach - not ideal for face recognition
             # but works as a fallback
-            encoding = img_array[:512]  # Take first 512 values
+            # Take the first 512 values, converting only those to float32 in [0, 1]
+            encoding = np.asarray(img).reshape(-1)[:512].astype(np.float32) / 255
             
             # Normalize the encoding
-            encoding = encoding / (np.linalg.norm(encoding) + 1e-8)
-            
-            return encoding.tolist()
+            return normalize(encoding)
         except:
             return None
     
-    def find_matches(self, query_encoding, threshold=0.6):
+    def find_matches(self, query_encoding, threshold=0.6, top_k=None):
         """
         Find matches for a query face encoding in the database.
         
         Args:
             query_encoding: list or numpy array of the face encoding to search for
             threshold: distance threshold for matching (lower = more strict)
+            top_k: return at most this many matches. None returns every match when
+                the whole matrix is scanned, but with an index (FAISS or hnswlib)
+                installed only the SEARCH_K (10) nearest faces are considered
         
         Returns:
-            List of matches with person_id, distance, and confidence
+            List of matches with person_id, distance, and confidence, closest first
         """
-        matches = []
-        
-        # Get all encodings from database
-        stored_encodings = get_all_face_encodings()
-        
-        if not stored_encodings:
-            return matches
-        
-        # Convert query encoding to numpy array if needed
-        if isinstance(query_encoding, list):
-            query_encoding = np.array(query_encoding)
-        
-        for stored in stored_encodings:
-            # Convert stored encoding to numpy array
-            stored_encoding = np.array(stored['encoding'])
-            
-            # Calculate cosine similarity (better for normalized vectors)
-            # Cosine similarity = 1 - cosine distance
-            dot_product = np.dot(query_encoding, stored_encoding)
-            norm_product = np.linalg.norm(query_encoding) * np.linalg.norm(stored_encoding)
-            
-            if norm_product == 0:
-                continue
-                
-            cosine_similarity = dot_product / norm_product
-            cosine_distance = 1 - cosine_similarity
-            
-            # Check if distance is below threshold
-            if cosine_distance <= threshold:
-                # Convert distance to confidence (0-1 scale, inverted)
-                confidence = 1 - (cosine_distance / threshold)
-                confidence = max(0, min(1, confidence))  # Clamp between 0 and 1
-                
-                matches.append({
-                    'person_id': stored['person_id'],
-                    'distance': float(cosine_distance),
-                    'confidence': float(confidence)
-                })
-        
-        # Sort by distance (closest first)
-        matches.sort(key=lambda x: x['distance'])
-        
-        return matches
+        person_ids, cosine_distances = cosine_search(query_encoding, threshold, top_k)
+        return select_matches(person_ids, cosine_distances, threshold, top_k)
     
     def compare_faces(self, encoding1, encoding2, threshold=0.6):
         """
-        Compare two face encodings.
+        Compare two face encodings, as returned by encode_face (unit length).
         Returns True if faces match, False otherwise.
         """
-        if isinstance(encoding1, list):
-            encoding1 = np.array(encoding1)
-        if isinstance(encoding2, list):
-            encoding2 = np.array(encoding2)
-        
-        # Calculate cosine distance
-        dot_product = np.dot(encoding1, encoding2)
-        norm_product = np.linalg.norm(encoding1) * np.linalg.norm(encoding2)
-        
-        if norm_product == 0:
-            return False, 1.0
+        encoding1 = as_vec(encoding1)
+        encoding2 = as_vec(encoding2)
         
-        cosine_similarity = dot_product / norm_product
-        cosine_distance = 1 - cosine_similarity
+        # On unit vectors cosine distance is one minus the dot product
+        cosine_distance = 1 - float(np.dot(encoding1, encoding2))
         
         return cosine_distance <= threshold, float(cosine_distance)
 
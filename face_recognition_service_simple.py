@@ -3,21 +3,181 @@ Simple face recognition service using Hugging Face API.
 This version works on Streamlit Cloud without TensorFlow/Keras dependencies.
 """
 import os
+import threading
 import numpy as np
 from PIL import Image
-import base64
-import io
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from huggingface_hub import InferenceClient
-from database import get_all_face_encodings
+from image_io import decode_image
+from encoding_cache import EncodingCache, content_hash
+from distance_kernels import as_vec, normalize, cosine_search, select_matches
 
 load_dotenv()
 
+ENCODER_SIZE = (224, 224)  # Images are scaled to this size before feature extraction
+ENCODING_SIZE = 512  # Length of every encoding; the 180 features are zero-padded to it
+IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF')  # Upload formats accepted by both apps
+
+# Numba compiles the image feature extraction into a single pass when installed
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Per-thread float32 pixel buffer, reused by every encoding on that thread
+_scratch = threading.local()
+
+def _pixel_buffer():
+    pixels = getattr(_scratch, 'pixels', None)
+    if pixels is None:
+        pixels = _scratch.pixels = np.empty((ENCODER_SIZE[1], ENCODER_SIZE[0], 3), dtype=np.float32)
+    return pixels
+
+def _load_encoder_image(image_source):
+    """Open an image (path, file object or file contents) and scale it to the encoder's 224x224 RGB input"""
+    if not isinstance(image_source, str):
+        data = image_source if isinstance(image_source, bytes) else image_source.read()
+        # JPEGs are decoded (and downscaled while decoding) by libjpeg-turbo when installed
+        img = Image.fromarray(decode_image(data, draft_size=ENCODER_SIZE, formats=IMAGE_FORMATS))
+        return img.resize(ENCODER_SIZE, Image.Resampling.BOX)
+    
+    # Only the upload formats are probed, instead of every plugin PIL knows
+    img = Image.open(image_source, formats=IMAGE_FORMATS)
+    # Let the JPEG decoder downscale while decoding instead of producing every full-size pixel
+    img.draft('RGB', ENCODER_SIZE)
+    # Box filtering averages each output pixel's area, which is all the histogram features need
+    return img.convert('RGB').resize(ENCODER_SIZE, Image.Resampling.BOX)
+
+def _image_features(img_array):
+    """
+    Histogram, patch and gradient features of a (224, 224, 3) float image in [0, 1],
+    written into a zero-padded float32 encoding of ENCODING_SIZE
+    """
+    features = np.zeros(ENCODING_SIZE, dtype=np.float32)
+    
+    # 1. Color histogram (RGB channels): quantize every pixel to one of 32 bins,
+    # then count each channel with a single bincount
+    bins = np.clip((img_array * 32).astype(np.int32), 0, 31)
+    hist = np.stack([np.bincount(bins[:, :, channel].ravel(), minlength=32) for channel in range(3)])
+    hist = hist / (hist.sum(axis=1, keepdims=True) + 1e-8)  # Normalize histogram
+    features[0:48] = hist[:, :16].ravel()  # Take first 16 bins
+    
+    # 2. Spatial features (grid-based sampling): view the image as an 8x8 grid
+    # of patches and reduce every patch at once, mean and std interleaved per patch
+    h, w = img_array.shape[:2]
+    grid_size = 8
+    patches = img_array.reshape(grid_size, h // grid_size, grid_size, w // grid_size, 3)
+    patch_means = patches.mean(axis=(1, 3, 4))
+    patch_stds = patches.std(axis=(1, 3, 4))
+    features[48:176:2] = patch_means.ravel()
+    features[49:176:2] = patch_stds.ravel()
+    
+    # 3. Edge-like features (gradient approximation); float64 so the sums of
+    # squares below do not lose the small gradients to cancellation
+    gray = img_array.mean(axis=2, dtype=np.float64)  # Convert to grayscale
+    features[176:178] = _diff_stats(gray, axis=1)
+    features[178:180] = _diff_stats(gray, axis=0)
+    
+    return features
+
+def _diff_stats(gray, axis):
+    """
+    Mean and std of np.diff(gray, axis=axis), computed from sums over gray
+    without allocating the difference array
+    """
+    h, w = gray.shape
+    flat = gray.ravel()
+    total_sq = np.vdot(flat, flat)
+    
+    if axis == 1:
+        n = h * (w - 1)
+        first, last = gray[:, 0], gray[:, -1]
+        # Neighbours in the flattened image, minus the pairs that wrap from one row to the next
+        cross = np.vdot(flat[1:], flat[:-1]) - np.vdot(last[:-1], first[1:])
+    else:
+        n = (h - 1) * w
+        first, last = gray[0], gray[-1]
+        cross = np.vdot(gray[1:], gray[:-1])
+    
+    # The differences telescope, so their sum is last minus first
+    mean = (last.sum() - first.sum()) / n
+    # sum((b - a)^2) = sum(b^2) + sum(a^2) - 2 sum(a b)
+    sum_sq = (total_sq - np.vdot(first, first)) + (total_sq - np.vdot(last, last)) - 2 * cross
+    return mean, np.sqrt(max(sum_sq / n - mean * mean, 0))
+
+if NUMBA_AVAILABLE:
+    @njit('float32[:](float32[:, :, ::1])', cache=True, fastmath=True, boundscheck=False, nogil=True)
+    def _image_features_numba(img_array):
+        """Same features as _image_features, computed in one compiled pass over the pixels"""
+        h, w = img_array.shape[0], img_array.shape[1]
+        grid_size = 8
+        patch_h, patch_w = h // grid_size, w // grid_size
+        
+        hist = np.zeros((3, 32), dtype=np.int64)
+        patch_sum = np.zeros((grid_size, grid_size))
+        patch_sq = np.zeros((grid_size, grid_size))
+        gray = np.empty((h, w))
+        
+        for i in range(h):
+            for j in range(w):
+                total = 0.0
+                total_sq = 0.0
+                for channel in range(3):
+                    value = img_array[i, j, channel]
+                    hist[channel, min(int(value * 32), 31)] += 1
+                    total += value
+                    total_sq += value * value
+                patch_sum[i // patch_h, j // patch_w] += total
+                patch_sq[i // patch_h, j // patch_w] += total_sq
+                gray[i, j] = total / 3
+        
+        # Gradient sums over the grayscale image
+        gx_sum = gx_sq = gy_sum = gy_sq = 0.0
+        for i in range(h):
+            for j in range(w):
+                if j + 1 < w:
+                    d = gray[i, j + 1] - gray[i, j]
+                    gx_sum += d
+                    gx_sq += d * d
+                if i + 1 < h:
+                    d = gray[i + 1, j] - gray[i, j]
+                    gy_sum += d
+                    gy_sq += d * d
+        
+        # Sums are accumulated in float64; the features are returned as float32
+        features = np.zeros(ENCODING_SIZE, dtype=np.float32)
+        for channel in range(3):
+            for b in range(16):
+                features[channel * 16 + b] = hist[channel, b] / (h * w + 1e-8)
+        
+        n = patch_h * patch_w * 3
+        for gi in range(grid_size):
+            for gj in range(grid_size):
+                mean = patch_sum[gi, gj] / n
+                features[48 + 2 * (gi * grid_size + gj)] = mean
+                features[49 + 2 * (gi * grid_size + gj)] = np.sqrt(max(patch_sq[gi, gj] / n - mean * mean, 0.0))
+        
+        k = 48 + 2 * grid_size * grid_size
+        nx = h * (w - 1)
+        ny = (h - 1) * w
+        gx_mean = gx_sum / nx
+        gy_mean = gy_sum / ny
+        features[k] = gx_mean
+        features[k + 1] = np.sqrt(max(gx_sq / nx - gx_mean * gx_mean, 0.0))
+        features[k + 2] = gy_mean
+        features[k + 3] = np.sqrt(max(gy_sq / ny - gy_mean * gy_mean, 0.0))
+        return features
+
 class FaceRecognitionService:
     """Service for face recognition operations using Hugging Face API"""
     
     def __init__(self):
         self.tolerance = 0.6  # Lower = more strict matching
+        self.encoding_cache = EncodingCache(maxsize=512)
+        # Decoding, resizing and the Numba features release the GIL, so batches encode in parallel
+        self.executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='simple-encoder')
         # Hugging Face API key is optional for this simple version
         # The simple encoding method works without it
         api_key = os.environ.get("HUGGINGFACE_API_KEY")
@@ -38,169 +198,96 @@ class FaceRecognitionService:
         Returns the face encoding as a list, or None if no face is found.
         """
         try:
-            # Read and encode image
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
+            # Decode and downscale the image once
+            img = _load_encoder_image(image_path)
             
-            # Use Hugging Face feature extraction API
-            # Note: The API might have rate limits, so we'll use a fallback
-            try:
-                # Open image with PIL for the API
-                img = Image.open(image_path).convert('RGB')
-                
-                # Try using the image feature extraction endpoint
-                # Note: This may require the image to be base64 encoded or in a specific format
-                # For now, use the simple encoding method which is more reliable
-                return self._simple_image_encoding(image_path)
-                    
-            except Exception as api_error:
-                # Fallback: Use a simple image-based encoding
-                print(f"API error: {api_error}, using fallback method")
-                return self._simple_image_encoding(image_path)
+            # The Hugging Face API might have rate limits, so for now use the
+            # simple encoding method which is more reliable
+            return self._simple_image_encoding(img)
                 
         except Exception as e:
             print(f"Error encoding face: {e}")
             return None
     
-    def _simple_image_encoding(self, image_path):
+    def encode_face_bytes(self, image_data, image_hash=None):
         """
-        Simple encoding method based on image features.
-        Uses image histogram and spatial features to create a unique encoding.
-        Note: This is a simplified approach. For better accuracy, consider using
-        a dedicated face recognition service or API.
+        Encode a face from the contents of an image file, without writing it to disk.
+        Identical uploads are answered from the encoding cache; image_hash is the
+        content_hash of image_data, if the caller already computed it.
+        Returns the face encoding as a list, or None if no face is found.
         """
         try:
-            # Load and preprocess image
-            img = Image.open(image_path).convert('RGB')
-            img = img.resize((224, 224))
-            
-            # Convert to array
-            img_array = np.array(img).astype(np.float32)
-            img_array = img_array / 255.0  # Normalize to [0, 1]
-            
-            # Create encoding from multiple image features
-            features = []
-            
-            # 1. Color histogram (RGB channels)
-            for channel in range(3):
-                hist, _ = np.histogram(img_array[:, :, channel], bins=32, range=(0, 1))
-                hist = hist / (hist.sum() + 1e-8)  # Normalize histogram
-                features.extend(hist[:16])  # Take first 16 bins
-            
-            # 2. Spatial features (grid-based sampling)
-            h, w = img_array.shape[:2]
-            grid_size = 8
-            for i in range(0, h, h // grid_size):
-                for j in range(0, w, w // grid_size):
-                    patch = img_array[i:i+h//grid_size, j:j+w//grid_size]
-                    features.append(patch.mean())
-                    features.append(patch.std())
-            
-            # 3. Edge-like features (gradient approximation)
-            gray = img_array.mean(axis=2)  # Convert to grayscale
-            # Simple gradient
-            grad_x = np.diff(gray, axis=1)
-            grad_y = np.diff(gray, axis=0)
-            features.append(grad_x.mean())
-            features.append(grad_x.std())
-            features.append(grad_y.mean())
-            features.append(grad_y.std())
-            
-            # Convert to numpy array and pad/trim to fixed size
-            encoding = np.array(features)
-            target_size = 512
-            
-            if len(encoding) < target_size:
-                # Pad with zeros
-                padding = np.zeros(target_size - len(encoding))
-                encoding = np.concatenate([encoding, padding])
-            elif len(encoding) > target_size:
-                # Trim
-                encoding = encoding[:target_size]
-            
-            # Normalize
-            norm = np.linalg.norm(encoding)
-            if norm > 0:
-                encoding = encoding / norm
-            
-            return encoding.tolist()
+            return self.encoding_cache.get_or_compute(
+                image_hash or content_hash(image_data), lambda: self._encode_face_bytes(image_data)
+            )
         except Exception as e:
-            print(f"Error in simple encoding: {e}")
+            # Failures are not cached, so the same photo is encoded again next time
+            print(f"Error encoding face: {e}")
             return None
     
-    def find_matches(self, query_encoding, threshold=0.6):
+    def _encode_face_bytes(self, image_data):
+        """Run the encoder on the contents of an image file; raises on errors"""
+        return self._simple_image_encoding(_load_encoder_image(image_data))
+    
+    def encode_faces_batch(self, image_paths, cache_keys=None):
+        """
+        Encode faces from several image files (paths or file-like objects), in parallel.
+        Returns a list with one face encoding (or None if no face is found) per image.
+        cache_keys, one content hash per file-like object, stores the results in the
+        encoding cache, except for images that failed to encode.
+        """
+        if cache_keys is None:
+            return list(self.executor.map(self.encode_face, image_paths))
+        return list(self.executor.map(
+            lambda source, key: self.encode_face_bytes(source.read(), key), image_paths, cache_keys
+        ))
+    
+    def _simple_image_encoding(self, img):
+        """
+        Simple encoding method based on image features, for a 224x224 RGB PIL image.
+        Uses image histogram and spatial features to create a unique encoding.
+        Note: This is a simplified approach. For better accuracy, consider using
+        a dedicated face recognition service or API. Raises on errors.
+        """
+        # Convert to float32 in [0, 1] with a single multiply into this thread's buffer
+        img_array = np.multiply(np.asarray(img), np.float32(1 / 255), out=_pixel_buffer())
+        
+        # Create encoding from multiple image features
+        if NUMBA_AVAILABLE:
+            encoding = _image_features_numba(img_array)
+        else:
+            encoding = _image_features(img_array)
+        
+        # Normalize
+        return normalize(encoding)
+    
+    def find_matches(self, query_encoding, threshold=0.6, top_k=None):
         """
         Find matches for a query face encoding in the database.
         
         Args:
             query_encoding: list or numpy array of the face encoding to search for
             threshold: distance threshold for matching (lower = more strict)
+            top_k: return at most this many matches. None returns every match when
+                the whole matrix is scanned, but with an index (FAISS or hnswlib)
+                installed only the SEARCH_K (10) nearest faces are considered
         
         Returns:
-            List of matches with person_id, distance, and confidence
+            List of matches with person_id, distance, and confidence, closest first
         """
-        matches = []
-        
-        # Get all encodings from database
-        stored_encodings = get_all_face_encodings()
-        
-        if not stored_encodings:
-            return matches
-        
-        # Convert query encoding to numpy array if needed
-        if isinstance(query_encoding, list):
-            query_encoding = np.array(query_encoding)
-        
-        for stored in stored_encodings:
-            # Convert stored encoding to numpy array
-            stored_encoding = np.array(stored['encoding'])
-            
-            # Calculate cosine similarity (better for normalized vectors)
-            dot_product = np.dot(query_encoding, stored_encoding)
-            norm_product = np.linalg.norm(query_encoding) * np.linalg.norm(stored_encoding)
-            
-            if norm_product == 0:
-                continue
-                
-            cosine_similarity = dot_product / norm_product
-            cosine_distance = 1 - cosine_similarity
-            
-            # Check if distance is below threshold
-            if cosine_distance <= threshold:
-                # Convert distance to confidence (0-1 scale, inverted)
-                confidence = 1 - (cosine_distance / threshold)
-                confidence = max(0, min(1, confidence))  # Clamp between 0 and 1
-                
-                matches.append({
-                    'person_id': stored['person_id'],
-                    'distance': float(cosine_distance),
-                    'confidence': float(confidence)
-                })
-        
-        # Sort by distance (closest first)
-        matches.sort(key=lambda x: x['distance'])
-        
-        return matches
+        person_ids, cosine_distances = cosine_search(query_encoding, threshold, top_k)
+        return select_matches(person_ids, cosine_distances, threshold, top_k)
     
     def compare_faces(self, encoding1, encoding2, threshold=0.6):
         """
-        Compare two face encodings.
+        Compare two face encodings, as returned by encode_face (unit length).
         Returns True if faces match, False otherwise.
         """
-        if isinstance(encoding1, list):
-            encoding1 = np.array(encoding1)
-        if isinstance(encoding2, list):
-            encoding2 = np.array(encoding2)
-        
-        # Calculate cosine distance
-        dot_product = np.dot(encoding1, encoding2)
-        norm_product = np.linalg.norm(encoding1) * np.linalg.norm(encoding2)
-        
-        if norm_product == 0:
-            return False, 1.0
+        encoding1 = as_vec(encoding1)
+        encoding2 = as_vec(encoding2)
         
-        cosine_similarity = dot_product / norm_product
-        cosine_distance = 1 - cosine_similarity
+        # On unit vectors cosine distance is one minus the dot product
+        cosine_distance = 1 - float(np.dot(encoding1, encoding2))
         
         return cosine_distance <= threshold, float(cosine_distance)
 
@@ -0,0 +1,212 @@
+"""
+Nearest-neighbour index over the stored face encodings.
+Lets find_matches look up the closest faces without scanning the whole database.
+FAISS is used when installed; large FAISS indexes store 8-bit scalar-quantized
+vectors (4x smaller than float32). Without FAISS, hnswlib provides the same HNSW
+search. Either way the returned candidates are re-ranked on their exact float32
+encodings. With neither library INDEX_AVAILABLE is False and the services fall
+back to a full scan of the embedding matrix.
+"""
+import os
+import threading
+import numpy as np
+
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+HNSWLIB_AVAILABLE = False
+if not FAISS_AVAILABLE:
+    try:
+        import hnswlib
+        HNSWLIB_AVAILABLE = True
+    except ImportError:
+        pass
+
+INDEX_AVAILABLE = FAISS_AVAILABLE or HNSWLIB_AVAILABLE
+
+INDEX_PATH = 'missing_persons_{metric}.faiss'
+HNSWLIB_INDEX_PATH = 'missing_persons_{metric}.hnsw'
+HNSW_NEIGHBORS = 32  # Graph degree (M) of the HNSW index
+HNSW_EF_CONSTRUCTION = 200  # Candidate list size while inserting (hnswlib)
+HNSW_EF_SEARCH = 64  # Candidate list size at query time (higher = better recall)
+SEARCH_K = 10  # Number of nearest faces returned per query
+SAVE_EVERY = 16  # Write the index to disk after this many inserts
+SQ_MIN_VECTORS = 1000  # Below this many faces the index keeps full float32 vectors
+
+# One index per distance metric ('cosine' or 'euclidean'), built on first search
+_indexes = {}
+_unsaved_inserts = {}
+# Number of leading rows of the embedding matrix each index holds
+_indexed_rows = {}
+# Reentrant: building an index reads the embedding matrix, which may sync the other indexes
+_lock = threading.RLock()
+
+def _prepare_vectors(vectors, metric):
+    """Convert encodings to the contiguous float32 rows the index expects"""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    if metric == 'cosine':
+        # On unit vectors the inner product equals cosine similarity
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    return vectors
+
+def _hnswlib_space(metric):
+    # Cosine vectors are normalized by _prepare_vectors, so inner product gives cosine order
+    return 'ip' if metric == 'cosine' else 'l2'
+
+def _set_ef_search(index):
+    faiss.downcast_index(index.index).hnsw.efSearch = HNSW_EF_SEARCH
+
+def _build_index(ids, matrix, metric):
+    """Build an HNSW index over all stored encodings and write it to disk"""
+    vectors = _prepare_vectors(matrix, metric)
+
+    if HNSWLIB_AVAILABLE:
+        index = hnswlib.Index(space=_hnswlib_space(metric), dim=matrix.shape[1])
+        index.init_index(max_elements=max(2 * len(ids), 1024), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_NEIGHBORS)
+        index.add_items(vectors, ids)
+        index.set_ef(HNSW_EF_SEARCH)
+        index.save_index(HNSWLIB_INDEX_PATH.format(metric=metric))
+        return index
+
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == 'cosine' else faiss.METRIC_L2
+    if len(ids) >= SQ_MIN_VECTORS:
+        # int8 codes with a trained per-dimension range; FAISS compares them with SIMD kernels
+        hnsw = faiss.IndexHNSWSQ(matrix.shape[1], faiss.ScalarQuantizer.QT_8bit, HNSW_NEIGHBORS, faiss_metric)
+        hnsw.train(vectors)
+    else:
+        hnsw = faiss.IndexHNSWFlat(matrix.shape[1], HNSW_NEIGHBORS, faiss_metric)
+
+    index = faiss.IndexIDMap(hnsw)
+    _set_ef_search(index)
+    index.add_with_ids(vectors, ids)
+    faiss.write_index(index, INDEX_PATH.format(metric=metric))
+    return index
+
+def _load_index(metric, dim):
+    """Read a saved index from disk, or return None if there is none"""
+    if HNSWLIB_AVAILABLE:
+        path = HNSWLIB_INDEX_PATH.format(metric=metric)
+        if not os.path.exists(path):
+            return None
+        index = hnswlib.Index(space=_hnswlib_space(metric), dim=dim)
+        index.load_index(path)
+        index.set_ef(HNSW_EF_SEARCH)
+        return index
+
+    path = INDEX_PATH.format(metric=metric)
+    if not os.path.exists(path):
+        return None
+    index = faiss.read_index(path)
+    _set_ef_search(index)
+    return index
+
+def _index_size(index):
+    return index.get_current_count() if HNSWLIB_AVAILABLE else index.ntotal
+
+def _save_index(index, metric):
+    if HNSWLIB_AVAILABLE:
+        index.save_index(HNSWLIB_INDEX_PATH.format(metric=metric))
+    else:
+        faiss.write_index(index, INDEX_PATH.format(metric=metric))
+
+def _get_index(metric):
+    """Return the index for a metric, loading it from disk or building it from the database"""
+    index = _indexes.get(metric)
+    if index is not None:
+        return index
+
+    from database import get_embedding_matrix
+    ids, matrix = get_embedding_matrix()
+    if len(ids) == 0:
+        return None
+
+    index = _load_index(metric, matrix.shape[1])
+    # A saved index that misses later inserts is rebuilt from scratch
+    if index is not None and _index_size(index) != len(ids):
+        index = None
+
+    if index is None:
+        index = _build_index(ids, matrix, metric)
+
+    _indexes[metric] = index
+    _unsaved_inserts[metric] = 0
+    _indexed_rows[metric] = len(ids)
+    return index
+
+def sync_index(ids, matrix):
+    """
+    Add the rows of the embedding matrix that the loaded indexes do not hold yet.
+    The matrix only ever grows at the end, so an older snapshot is simply a no-op.
+    Must not be called while holding database._write_lock: building an index
+    takes that lock while holding _lock.
+    """
+    if not INDEX_AVAILABLE:
+        return
+
+    with _lock:
+        for metric, index in _indexes.items():
+            start = _indexed_rows[metric]
+            if len(ids) <= start:
+                continue
+            vectors = _prepare_vectors(matrix[start:], metric)
+            new_ids = np.asarray(ids[start:], dtype=np.int64)
+            if HNSWLIB_AVAILABLE:
+                # hnswlib indexes have a fixed capacity; grow it geometrically
+                needed = index.get_current_count() + len(new_ids)
+                if needed > index.get_max_elements():
+                    index.resize_index(max(2 * index.get_max_elements(), needed))
+                index.add_items(vectors, new_ids)
+            else:
+                index.add_with_ids(vectors, new_ids)
+
+            _indexed_rows[metric] = len(ids)
+            _unsaved_inserts[metric] += len(new_ids)
+            if _unsaved_inserts[metric] >= SAVE_EVERY:
+                _save_index(index, metric)
+                _unsaved_inserts[metric] = 0
+
+def search_index(query_encoding, metric='cosine', k=SEARCH_K):
+    """
+    Find the k stored encodings closest to the query.
+
+    Args:
+        query_encoding: face encoding to search for
+        metric: 'cosine' for cosine distance, 'euclidean' for Euclidean distance
+        k: maximum number of results
+
+    Returns:
+        (ids, distances) numpy arrays, closest first
+    """
+    with _lock:
+        index = _get_index(metric)
+        if index is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = _prepare_vectors(query_encoding, metric)
+        if HNSWLIB_AVAILABLE:
+            # hnswlib refuses a k larger than the number of stored faces
+            labels, _ = index.knn_query(query, k=min(k, index.get_current_count()))
+            labels = labels.astype(np.int64)
+        else:
+            _, labels = index.search(query, k)
+
+    # FAISS pads with -1 when fewer than k faces are stored
+    ids = labels[0][labels[0] >= 0]
+
+    # Re-rank the candidates on their exact float32 encodings, so quantization
+    # only affects which faces are found, never the reported distances
+    from database import get_embedding_matrix
+    stored_ids, matrix = get_embedding_matrix()
+    rows = np.searchsorted(stored_ids, ids)
+    rows = rows[(rows < len(stored_ids)) & (stored_ids[np.minimum(rows, len(stored_ids) - 1)] == ids)]
+    ids = stored_ids[rows]
+
+    if metric == 'cosine':
+        distances = 1 - _prepare_vectors(matrix[rows], metric) @ query[0]
+    else:
+        distances = np.linalg.norm(matrix[rows] - query[0], axis=1)
+
+    order = np.argsort(distances, kind='stable')
+    return ids[order], distances[order]
@@ -0,0 +1,53 @@
+"""
+Image decoding for uploaded photos.
+JPEGs are decoded with libjpeg-turbo (PyTurboJPEG) when it is installed, which
+is several times faster than PIL on large phone photos. Everything else, and
+every JPEG when PyTurboJPEG is missing, goes through PIL.
+"""
+import io
+import numpy as np
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_BGR
+    _turbojpeg = TurboJPEG()
+except Exception:
+    # Either the package or the libturbojpeg shared library is missing
+    _turbojpeg = None
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+def _turbojpeg_scaling_factor(image_data, draft_size):
+    """Smallest libjpeg-turbo scaling factor that keeps the image at least draft_size (width, height)"""
+    width, height, _, _ = _turbojpeg.decode_header(image_data)
+    best = None
+    for num, denom in _turbojpeg.scaling_factors:
+        if width * num // denom >= draft_size[0] and height * num // denom >= draft_size[1]:
+            if best is None or num / denom < best[0] / best[1]:
+                best = (num, denom)
+    return best
+
+def decode_image(image_data, channel_order='RGB', draft_size=None, formats=None):
+    """
+    Decode the contents of an image file into a uint8 numpy array of shape (H, W, 3).
+    channel_order is 'RGB', or 'BGR' for OpenCV-based libraries such as DeepFace.
+    draft_size (width, height) lets JPEGs be downscaled while decoding, as long as
+    the result stays at least that large; callers still resize to the exact size.
+    formats limits which PIL decoders are tried for non-JPEG data.
+    """
+    if _turbojpeg is not None and image_data[:3] == JPEG_MAGIC:
+        pixel_format = TJPF_BGR if channel_order == 'BGR' else TJPF_RGB
+        try:
+            scaling_factor = _turbojpeg_scaling_factor(image_data, draft_size) if draft_size else None
+            return _turbojpeg.decode(image_data, pixel_format=pixel_format, scaling_factor=scaling_factor)
+        except Exception:
+            # Unusual JPEGs (e.g. CMYK) fall through to PIL
+            pass
+
+    image = Image.open(io.BytesIO(image_data), formats=formats)
+    if draft_size:
+        image.draft('RGB', draft_size)
+    image = np.array(image.convert('RGB'))
+    if channel_order == 'BGR':
+        image = np.ascontiguousarray(image[:, :, ::-1])
+    return image
@@ -2,7 +2,8 @@ import streamlit as st
 import os
 from PIL import Image
 import io
-from database import init_db, add_missing_person, get_all_missing_persons, get_missing_person_by_id
+from database import init_db, add_missing_person, get_all_missing_persons, count_missing_persons, get_missing_persons_by_ids, get_missing_person_by_image_hash
+from encoding_cache import content_hash
 
 # Use simple Hugging Face-based service (works on Streamlit Cloud without TensorFlow)
 try:
@@ -32,11 +33,13 @@ st.set_page_config(
 # Initialize database
 init_db()
 
-# Initialize face recognition service
-if 'face_service' not in st.session_state:
-    st.session_state.face_service = FaceRecognitionService()
+# Initialize face recognition service once per process, so every session shares
+# the loaded model and its cache of encodings keyed by upload content hash
+@st.cache_resource
+def get_face_service():
+    return FaceRecognitionService()
 
-face_service = st.session_state.face_service
+face_service = get_face_service()
 
 # Custom CSS for better styling
 st.markdown("""
@@ -97,33 +100,25 @@ if page == "Search":
         
         if st.button("🔍 Search Database", type="primary"):
             with st.spinner("Analyzing face and searching database..."):
-                # Save uploaded file temporarily
-                os.makedirs('uploads', exist_ok=True)
-                temp_path = os.path.join('uploads', f'temp_{uploaded_file.name}')
-                
-                # Save PIL image to file
-                image.save(temp_path)
-                
-                # Encode the face
-                encoding = face_service.encode_face(temp_path)
+                # Encode the face straight from the uploaded bytes
+                encoding = face_service.encode_face_bytes(uploaded_file.getvalue())
                 
                 if encoding is None:
                     st.error("❌ No face detected in image. Please upload a clear photo with a visible face.")
-                    os.remove(temp_path)
                 else:
                     # Search for matches
-                    matches = face_service.find_matches(encoding, threshold=0.6)
-                    
-                    # Clean up temp file
-                    os.remove(temp_path)
+                    matches = face_service.find_matches(encoding, threshold=0.6, top_k=10)
                     
                     if len(matches) == 0:
                         st.success("✅ No matches found. The person in the photo does not match anyone in the database.")
                     else:
                         st.success(f"✅ Found {len(matches)} match(es):")
                         
+                        # Fetch all matched persons in a single query
+                        persons = get_missing_persons_by_ids([match['person_id'] for match in matches])
+                        
                         for match in matches:
-                            person = get_missing_person_by_id(match['person_id'])
+                            person = persons.get(match['person_id'])
                             if person:
                                 confidence = round(match['confidence'] * 100, 2)
                                 
@@ -188,27 +183,31 @@ elif page == "Add Missing Person":
         submitted = st.form_submit_button("➕ Add to Database", type="primary")
         
         if submitted:
+            image_hash = content_hash(photo.getvalue()) if photo else None
+            existing = get_missing_person_by_image_hash(image_hash) if image_hash else None
+            
             if not name:
                 st.error("❌ Name is required")
             elif not photo:
                 st.error("❌ Photo is required")
+            elif existing:
+                st.warning(f"⚠️ This photo has already been added (ID: {existing['id']})")
             else:
                 with st.spinner("Processing image and adding to database..."):
-                    # Save uploaded file
-                    os.makedirs('uploads', exist_ok=True)
-                    filepath = os.path.join('uploads', photo.name)
-                    
-                    # Save PIL image to file
-                    image = Image.open(photo)
-                    image.save(filepath)
-                    
-                    # Process face encoding
-                    encoding = face_service.encode_face(filepath)
+                    # Process face encoding from the uploaded bytes
+                    image_data = photo.getvalue()
+                    encoding = face_service.encode_face_bytes(image_data)
                     
                     if encoding is None:
                         st.error("❌ No face detected in image. Please upload a clear photo with a visible face.")
-                        os.remove(filepath)
                     else:
+                        # Save the uploaded file as-is, without re-encoding it
+                        os.makedirs('uploads', exist_ok=True)
+                        # The content hash prefix keeps photos with the same file name apart
+                        filepath = os.path.join('uploads', f"{image_hash[:16]}_{photo.name}")
+                        with open(filepath, 'wb') as f:
+                            f.write(image_data)
+                        
                         # Add to database
                         person_id = add_missing_person(
                             name=name,
@@ -217,7 +216,8 @@ elif page == "Add Missing Person":
                             date_missing=str(date_missing) if date_missing else None,
                             contact=contact if contact else None,
                             photo_path=filepath,
-                            face_encoding=encoding
+                            face_encoding=encoding,
+                            image_hash=image_hash
                         )
                         
                         st.success(f"✅ Missing person added successfully! (ID: {person_id})")
@@ -228,12 +228,18 @@ elif page == "View All":
     st.header("All Missing Persons")
     st.write("View all persons in the database")
     
-    persons = get_all_missing_persons()
+    total = count_missing_persons()
     
-    if len(persons) == 0:
+    if total == 0:
         st.info("ℹ️ No missing persons in database yet.")
     else:
-        st.write(f"**Total:** {len(persons)} person(s)")
+        st.write(f"**Total:** {total} person(s)")
+        
+        # Load one page at a time instead of the whole table
+        page_size = 30
+        page_count = (total + page_size - 1) // page_size
+        page_number = st.number_input("Page", min_value=1, max_value=page_count, value=1) if page_count > 1 else 1
+        persons = get_all_missing_persons(limit=page_size, offset=(page_number - 1) * page_size)
         
         # Display in a grid
         cols = st.columns(3)